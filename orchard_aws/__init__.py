@@ -1,4 +1,3 @@
 from orchard_aws.s3 import *
 from orchard_aws.redshift import *
 from orchard_aws.sql_generator import *
-from orchard_aws.string_utils import *
\ No newline at end of file
@@ -1,9 +1,24 @@
-import yaml
 import os
+from functools import lru_cache
+from types import MappingProxyType
+
 config_path = os.path.dirname(os.path.abspath(__file__))
 
 
+@lru_cache(maxsize=None)
 def get(config):
-    with open(config_path + '/%s.yaml' % config) as f:
-        return yaml.safe_load(f)
-
+    """
+        Returns the parsed contents of config/<config>.yaml. Each file is only
+        read once per process; mappings are returned read-only since the same
+        object is shared by every caller.
+    """
+    import yaml
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+    with open(os.path.join(config_path, '%s.yaml' % config)) as f:
+        data = yaml.load(f, Loader=Loader)
+    if isinstance(data, dict):
+        return MappingProxyType(data)
+    return data
@@ -1,19 +1,45 @@
-import pandas as pd
+import hashlib
+import io
 import logging
-import psycopg2
-import json
+import os
+import threading
 import time
 import uuid
 
-from .s3 import s3
+from .s3 import s3, COMPRESSION_EXTENSIONS
 from .sql_generator import *
 
 log = logging.getLogger('Redshift Conn')
 
+# connection pools shared by pooled Redshift objects, keyed by process id and
+# connection parameters so a forked child never reuses its parent's sockets
+pools = {}
+pools_lock = threading.Lock()
+POOL_MAX_CONNECTIONS = 8
+
+
+def get_df_content_hash(df, *params):
+    """
+        Returns a hex digest of a DataFrame's column names, dtypes and values. The index is
+        ignored since it isn't uploaded. Extra params (e.g. file format) are mixed into the hash.
+    """
+    import pandas as pd
+    digest = hashlib.blake2b(digest_size=16)
+    header = (list(df.columns), [str(dtype) for dtype in df.dtypes], params)
+    digest.update(repr(header).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
 
 class Redshift(object):
     """This class is the main driver for interacting with a redshift instance.
 
+    By default each object opens its own connection. With pooled=True, connections
+    come from a pool shared by every pooled Redshift object with the same connection
+    parameters in the same process, and close() hands the connection back to that
+    pool. At most POOL_MAX_CONNECTIONS can be checked out per pool at a time, so
+    pooled objects should be closed (or used as a context manager) when done.
+
     TODO:
         - Do we need to lock tables when we upsert? See generate_lock_query()
         - Write 'grant' permissions functions to run after upserts
@@ -38,6 +64,9 @@ class Redshift(object):
         Description of parameter `secret_key`.
     s3_bucket : type
         Name of S3 bucket.
+    pooled : bool
+        Take connections from a shared pool instead of opening a new one.
+        Default: False
 
     """
     def __init__(self,
@@ -48,18 +77,21 @@ class Redshift(object):
                  password,
                  access_key=None,
                  secret_key=None,
-                 s3_bucket=None):
+                 s3_bucket=None,
+                 pooled=False):
         self.dbname = dbname
         self.host = host
         self.port = port
         self.user = user
         self.password = password
+        self.pooled = pooled
+        self.pool = None
         self.conn = None
         try:
             self.conn = self.connect()
-        except (Exception, psycopg2.Error) as error:
-            log.error('Could not connect to {}. Trying once more.'.format(
-                self.dbname))
+        except Exception as error:
+            log.error('Could not connect to {}: {}. Trying once more.'.format(
+                self.dbname, error))
             time.sleep(5)
             self.conn = self.connect()
 
@@ -70,46 +102,99 @@ class Redshift(object):
 
     def connect(self):
         """
-            Returns the connection to redshift
+            Returns a connection to redshift. When pooled, the connection is taken
+            from the pool for this process and connection parameters, which is
+            created on first use.
         """
-        self.conn = psycopg2.connect(dbname=self.dbname,
-                                     host=self.host,
-                                     port=self.port,
-                                     user=self.user,
-                                     password=self.password)
+        if not self.pooled:
+            import psycopg2
+            self.conn = psycopg2.connect(dbname=self.dbname,
+                                         host=self.host,
+                                         port=self.port,
+                                         user=self.user,
+                                         password=self.password)
+            return self.conn
+
+        from psycopg2.pool import ThreadedConnectionPool
+        pool_key = (os.getpid(), self.host, self.port, self.dbname, self.user,
+                    self.password)
+        with pools_lock:
+            if pool_key not in pools:
+                pools[pool_key] = ThreadedConnectionPool(
+                    1,
+                    POOL_MAX_CONNECTIONS,
+                    dbname=self.dbname,
+                    host=self.host,
+                    port=self.port,
+                    user=self.user,
+                    password=self.password)
+            self.pool = pools[pool_key]
+        self.conn = self.pool.getconn()
         return self.conn
 
     def close(self):
+        """
+            Closes the connection, or returns it to the pool when pooled. Any open
+            transaction is rolled back. The next query connects again.
+        """
         log.info('Closing redshift connection')
-        self.conn.close()
+        if self.conn is not None:
+            if self.pool is not None:
+                self.pool.putconn(self.conn)
+            else:
+                self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # hand a pooled connection back if the object was never closed, so it
+        # doesn't hold a pool slot for the rest of the process
+        try:
+            if getattr(self, 'conn', None) is not None:
+                self.close()
+        except Exception:
+            pass
+
+    def cursor(self):
+        """
+            Returns a new cursor, connecting again if this object doesn't currently
+            hold a connection.
+        """
+        if self.conn is None:
+            self.connect()
+        return self.conn.cursor()
 
     def execute_and_fetch(self,
                           query,
                           return_dataframe=False,
                           return_json=False):
         """
-            Returns results from a query in either json or a dataframe.
+            Returns results from a query in either json (a list of dicts, one per row)
+            or a dataframe. When neither is requested, returns the rows as a list of tuples.
         """
+        if return_dataframe and return_json:
+            raise Exception(
+                'return_dataframe and return_json are mutually exclusive.')
         cur = None
         try:
-            cur = self.conn.cursor()
+            cur = self.cursor()
             cur.execute(query)
             resp = cur.fetchall()
-            if cur is not None:
-                cur.close()
-            if return_dataframe == return_json:
-                raise Exception(
-                    'return_dataframe and return_json are mutually exclusive.')
+            columns = [column[0] for column in cur.description]
             if return_dataframe is True:
-                columns = [column[0] for column in cur.description]
-                return pd.DataFrame(resp, columns=columns)
+                import pandas as pd
+                return pd.DataFrame.from_records(resp,
+                                                 columns=columns,
+                                                 coerce_float=False)
             elif return_json is True:
-                columns = [column[0] for column in cur.description]
-                return json.loads(
-                    pd.DataFrame(resp,
-                                 columns=columns).to_json(orient='records'))
+                return [dict(zip(columns, row)) for row in resp]
             else:
-                return response
+                return resp
         except Exception as e:
             log.info(
                 'Encountered an error while executing. Closing connection')
@@ -125,7 +210,7 @@ class Redshift(object):
         """
         cur = None
         try:
-            cur = self.conn.cursor()
+            cur = self.cursor()
             cur.execute(query)
             self.conn.commit()
         except Exception as e:
@@ -137,6 +222,26 @@ class Redshift(object):
             if cur is not None:
                 cur.close()
 
+    def execute_many(self, queries):
+        """
+            Executes a list of SQL statements against redshift on one cursor and
+            commits once at the end, so they either all apply or none do.
+        """
+        cur = None
+        try:
+            cur = self.cursor()
+            for query in queries:
+                cur.execute(query)
+            self.conn.commit()
+        except Exception as e:
+            log.error(
+                'Encountered an error while executing. Closing connection')
+            self.close()
+            raise
+        finally:
+            if cur is not None:
+                cur.close()
+
     def df_to_redshift(self,
                        df,
                        schema_and_table,
@@ -148,10 +253,12 @@ class Redshift(object):
                        bucket=None,
                        subdirectory='automated-loads',
                        encoding='utf-8',
-                       keep_s3_backup=False):
+                       keep_s3_backup=False,
+                       file_format='csv',
+                       compression='gzip'):
         """
             Upserts a DataFrame to a redshift table. The high level design is as follows:
-                1. Upload the DataFrame as csv to a directory in s3
+                1. Upload the DataFrame as csv (or parquet) to a directory in s3
                 2. If load_type == 'full-refresh', drop the table in redshift
                 3. If table doesn't exist, create an empty table deriving the table defintion from the DataFrame.
                 4. Copy the file from s3 into a temporary staging table
@@ -188,42 +295,85 @@ class Redshift(object):
                 By default we delete the s3 file after completing the upsert. When True, we keep the file in s3.
                 Default: False
 
+            file_format: str
+                format of the staging file in s3, either 'csv' or 'parquet'. Parquet is smaller and faster to
+                serialize, but requires pyarrow and column types that match the table definition.
+                Default: 'csv'
+
+            compression: str
+                compression for csv staging files, either None, 'gzip' or 'zstd' (requires zstandard).
+                Ignored for parquet.
+                Default: 'gzip'
+
         """
         if load_type == 'incremental' and primary_keys == []:
             raise Exception('Must pass primary keys for incremental loads.')
-
-        # drop table when full refresh
-        if load_type == 'full-refresh':
-            drop_table_query = get_drop_table_query(schema_and_table)
-            self.execute(drop_table_query)
-
-        # create empty table
-        if not self.check_table_exists(schema_and_table=schema_and_table):
-            self.create_table_from_df(schema_and_table=schema_and_table,
-                                      df=df,
-                                      diststyle=diststyle,
-                                      sortkey=sortkey)
-
-        # upload df to s3
+        if file_format not in ('csv', 'parquet'):
+            raise Exception('file_format must be either csv or parquet.')
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise Exception('compression must be None, gzip or zstd.')
+        if file_format == 'parquet':
+            compression = None
+            try:
+                import pyarrow
+            except ImportError:
+                raise Exception('file_format parquet requires pyarrow.')
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('compression zstd requires zstandard.')
+
+        # upload df to s3. Kept backups are named by their contents so a re-run can
+        # reuse the file; files deleted after the load get a unique name so that
+        # concurrent loads of the same data never delete each other's file
         table = schema_and_table.split('.')[1]
-        csv_name = '{}-{}.csv'.format(table, uuid.uuid4())
-        log.info('Uploaded {} to s3 directory {}'.format(
-            csv_name, subdirectory))
+        content_hash = None
+        if keep_s3_backup:
+            try:
+                content_hash = get_df_content_hash(df, file_format, encoding,
+                                                   compression)
+            except TypeError:
+                # unhashable values, e.g. lists in an object column
+                pass
+        # only a hashed name can already exist, so uuid names skip the existence
+        # check and conditional write
+        file_id = content_hash or uuid.uuid4()
+        file_name = '{}-{}.{}{}'.format(table, file_id, file_format,
+                                        COMPRESSION_EXTENSIONS[compression])
         key = self.s3_conn.df_to_s3(df,
-                                    csv_name,
+                                    file_name,
                                     bucket=bucket,
                                     subdirectory=subdirectory,
-                                    encoding=encoding)
+                                    encoding=encoding,
+                                    file_format=file_format,
+                                    compression=compression,
+                                    overwrite=content_hash is None)
+        if key is None:
+            raise Exception('Could not upload {} to s3.'.format(file_name))
+        log.info('Uploaded {} to s3 directory {}'.format(
+            file_name, subdirectory))
+        # an empty frame is enough to derive the table definition from
+        dtypes_from = df.head(0)
         df = None
 
+        # drop table when full refresh
+        if load_type == 'full-refresh':
+            drop_table_query = get_drop_table_query(schema_and_table)
+            self.execute(drop_table_query)
+
         # populate the table from the data in s3
         self.s3_to_redshift(key=key,
                             schema_and_table=schema_and_table,
                             sortkey=sortkey,
                             columns=columns,
                             primary_keys=primary_keys,
+                            diststyle=diststyle,
                             encoding=encoding,
-                            load_type=load_type)
+                            load_type=load_type,
+                            file_format=file_format,
+                            compression=compression,
+                            dtypes_from=dtypes_from)
         # delete the file
         if not keep_s3_backup:
             self.s3_conn.delete_file(key)
@@ -237,37 +387,94 @@ class Redshift(object):
                        primary_keys=[],
                        bucket=None,
                        diststyle='auto',
-                       encoding='utf-8'):
+                       encoding='utf-8',
+                       file_format='csv',
+                       compression=None,
+                       dtypes_from=None):
+        """
+            Upserts a file in s3 into a redshift table, creating the table first if it doesn't exist.
+
+            Parameters
+            -------
+            dtypes_from: DataFrame
+                frame to derive the table definition from when the table doesn't exist. Only the
+                dtypes are used, so an empty frame (df.head(0)) is enough. When None, the file is
+                downloaded from s3 to infer them.
+                Default: None
+
+            compression: str
+                compression of a csv file, either None, 'gzip' or 'zstd'.
+                Default: None
+        """
+        if not self.check_table_exists(schema_and_table=schema_and_table):
+            if dtypes_from is None:
+                log.info('Reading {} to derive the table definition'.format(key))
+                if file_format == 'parquet':
+                    import pandas as pd
+                    body = self.s3_conn.from_s3(key, bucket=bucket)
+                    dtypes_from = pd.read_parquet(io.BytesIO(body.read()))
+                else:
+                    dtypes_from = self.s3_conn.s3_to_df(
+                        key, bucket=bucket, compression=compression)
+                    if dtypes_from is None:
+                        raise Exception(
+                            'Could not read {} to derive the table definition.'.
+                            format(key))
+            self.create_table_from_df(schema_and_table=schema_and_table,
+                                      df=dtypes_from,
+                                      diststyle=diststyle,
+                                      sortkey=sortkey)
 
         log.info('Performing Upsert')
-        self.upsert_from_s3(schema_and_table, key, bucket, primary_keys)
+        self.upsert_from_s3(schema_and_table,
+                            key,
+                            bucket,
+                            primary_keys,
+                            file_format=file_format,
+                            compression=compression)
         log.info('Done Upserting into Redshift')
 
-    def upsert_from_s3(self, schema_and_table, key, bucket, primary_keys):
+    def upsert_from_s3(self,
+                       schema_and_table,
+                       key,
+                       bucket,
+                       primary_keys,
+                       file_format='csv',
+                       compression=None):
         """
             Create a temporary staging table in redshift. Copy data from s3 file into
             temporary staging table. Upsert (insert/update) rows from temporary table into
-            destination table. Delete temporary table.
+            destination table. Delete temporary table. All of the statements run in a
+            single transaction.
         """
-        temp_table = self.create_temp_staging_table(schema_and_table)
+        temp_table, queries = self.get_temp_staging_table_queries(
+            schema_and_table)
 
         # Copy s3 file into temp table
         temp_s3_path = "{}/{}".format(self.s3_conn.bucket, key)
-        temp_copy_parameters = [
-            "CSV DELIMITER AS ',' NULL AS 'NaN' BLANKSASNULL", "COMPUPDATE OFF"
-        ]
+        if file_format == 'parquet':
+            temp_copy_parameters = []
+        else:
+            temp_copy_parameters = [
+                "CSV DELIMITER AS ',' NULL AS 'NaN' BLANKSASNULL",
+                "COMPUPDATE OFF"
+            ]
         log.debug('Copying {} into {}'.format(temp_s3_path, temp_table))
-        self.copy_from_s3(schema_and_table=temp_table,
-                          s3_path=temp_s3_path,
-                          extra_params=temp_copy_parameters)
+        queries.append(
+            self.get_copy_query(schema_and_table=temp_table,
+                                s3_path=temp_s3_path,
+                                extra_params=temp_copy_parameters,
+                                file_format=file_format,
+                                compression=compression))
 
         # upsert temp table into prod table
-        self.upsert(source=temp_table,
-                    dest=schema_and_table,
-                    primary_keys=primary_keys)
+        queries.extend(
+            self.get_upsert_queries(source=temp_table,
+                                    dest=schema_and_table,
+                                    primary_keys=primary_keys))
         log.debug('Dropping temp table {}'.format(temp_table))
-        drop_temp_table_query = get_drop_table_query(temp_table)
-        self.execute(drop_temp_table_query)
+        queries.append(get_drop_table_query(temp_table))
+        self.execute_many(queries)
 
     def upsert(self, source, dest, primary_keys):
         """
@@ -275,36 +482,66 @@ class Redshift(object):
                 1. If primary keys are passed, delete and insert rows in destination where the primary
                 key exists in source
                 2. Insert source into destination
+            The delete and insert are committed together.
         """
+        self.execute_many(self.get_upsert_queries(source, dest, primary_keys))
+
+    def get_upsert_queries(self, source, dest, primary_keys):
+        """
+            Returns the delete (when primary keys are passed) and insert statements used by upsert().
+        """
+        queries = []
         if primary_keys:
             delete_dest_rows_query = get_delete_from_dest_using_source_query(
                 source, dest, primary_keys)
             log.info('Deleting records from {} using: {}'.format(
                 dest, primary_keys))
-            self.execute(delete_dest_rows_query)
+            queries.append(delete_dest_rows_query)
 
         log.info('Inserting records from {}'.format(source))
         insert_rows_from_source_query = get_insert_from_source_into_dest_query(
             source, dest)
-        self.execute(insert_rows_from_source_query)
+        queries.append(insert_rows_from_source_query)
+        return queries
 
     def copy_from_s3(self,
                      schema_and_table,
                      s3_path,
                      extra_params,
-                     columns=''):
+                     columns='',
+                     file_format='csv',
+                     compression=None):
         """
             Executes a copy statement to load s3 into a redshift table. Note, this copies all columns by default.
         """
+        copy_query_with_creds = self.get_copy_query(
+            schema_and_table=schema_and_table,
+            s3_path=s3_path,
+            extra_params=extra_params,
+            columns=columns,
+            file_format=file_format,
+            compression=compression)
+        self.execute(copy_query_with_creds)
+
+    def get_copy_query(self,
+                       schema_and_table,
+                       s3_path,
+                       extra_params,
+                       columns='',
+                       file_format='csv',
+                       compression=None):
+        """
+            Returns the copy statement used by copy_from_s3(), with the s3 credentials filled in.
+        """
         copy_query = get_copy_from_s3_query(schema_and_table=schema_and_table,
                                             columns=columns,
                                             s3_path=s3_path,
-                                            extra_params=extra_params)
+                                            extra_params=extra_params,
+                                            file_format=file_format,
+                                            compression=compression)
         log.debug('Copy query:\n{}'.format(copy_query))
-        copy_query_with_creds = copy_query.format(
-            access_key=self.s3_conn.access_key,
-            secret_key=self.s3_conn.secret_key)
-        self.execute(copy_query_with_creds)
+        return copy_query.format(access_key=self.s3_conn.access_key,
+                                 secret_key=self.s3_conn.secret_key)
 
     def create_temp_staging_table(self, schema_and_table):
         """
@@ -315,19 +552,27 @@ class Redshift(object):
             schema_and_table: str
                 name of table to copy schema from
         """
+        temp_table, queries = self.get_temp_staging_table_queries(
+            schema_and_table)
+        self.execute_many(queries)
+        return temp_table
+
+    def get_temp_staging_table_queries(self, schema_and_table):
+        """
+            Returns the name of the temporary staging table for schema_and_table and the
+            statements that (re)create it.
+        """
         table = schema_and_table.split('.')[1]
         temp_table = "{}__tmp".format(table)
 
         # ensure temp does not exist
         drop_temp_table_query = get_drop_table_query(temp_table)
-        self.execute(drop_temp_table_query)
 
         # create temp staging table
         temp_table_query = get_create_temp_staging_table_query(
             temp_table, schema_and_table)
         log.debug('Creating temp staging table {}'.format(temp_table))
-        self.execute(temp_table_query)
-        return temp_table
+        return temp_table, [drop_temp_table_query, temp_table_query]
 
     def check_table_exists(self,
                            schema_and_table=None,
@@ -363,14 +608,25 @@ class Redshift(object):
             sortkey=sortkey)
         log.info(f'Creating schema and table: {schema_and_table}')
         log.debug(create_schema_query)
-        self.execute(create_schema_query)
         log.debug(create_table_query)
-        self.execute(create_table_query)
+        self.execute_many([create_schema_query, create_table_query])
 
     def generate_lock_query(self, table_list):
-        existing_tables = [
-            table for table in table_list if self.check_table_exists(table)
-        ]
+        """
+            Returns a lock statement for the tables in table_list that exist, or None
+            when none of them do. Existence is checked with a single query.
+
+            Parameters
+            -------
+            table_list: list of strings
+                schema qualified table names, e.g. ['public.orders']
+        """
+        if not table_list:
+            return None
+        query = get_tables_exist_query(table_list)
+        resp = self.execute_and_fetch(query, return_json=True)
+        found = {row['schema_and_table'] for row in resp}
+        existing_tables = [table for table in table_list if table in found]
         if existing_tables:
             return 'LOCK {};'.format(','.join(existing_tables))
         else:
@@ -1,6 +1,8 @@
-import pandas as pd
 import logging
-import boto3
+import codecs
+import io
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # TODO: Look up what these are
 import gzip
@@ -8,6 +10,66 @@ from gzip import compress
 
 log = logging.getLogger('S3 Conn')
 
+MB = 1024**2
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# error codes s3 returns when a conditional (IfNoneMatch) write finds an object
+CONDITIONAL_WRITE_ERRORS = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+# rows serialized at a time when streaming a DataFrame to s3
+CSV_CHUNK_ROWS = 100000
+
+
+def write_csv(df, fileobj, encoding='utf-8', header=True):
+    """
+        Writes a DataFrame as csv, without the index, to a binary file-like object.
+
+        Frames where every column is an integer or float are written with pyarrow's
+        csv writer, which is several times faster than DataFrame.to_csv. Everything
+        else, or when pyarrow isn't installed, goes through pandas.
+    """
+    numeric = all(dtype.kind in 'iuf' for dtype in df.dtypes)
+    if numeric and codecs.lookup(encoding).name == 'utf-8':
+        try:
+            import pyarrow as pa
+            import pyarrow.csv
+        except ImportError:
+            pass
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            options = pyarrow.csv.WriteOptions(include_header=header)
+            pyarrow.csv.write_csv(table, fileobj, write_options=options)
+            return
+    df.to_csv(fileobj, index=False, encoding=encoding, header=header)
+
+
+def get_compressor(compression):
+    """
+        Returns an object with compress(bytes) and flush() methods that produces a gzip
+        or zstd stream, or None when compression is None. zstd requires zstandard.
+    """
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        # wbits=31 writes a gzip header and trailer rather than raw zlib
+        return zlib.compressobj(wbits=31)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise Exception('compression must be None, gzip or zstd.')
+
+
+def get_compression_from_key(key):
+    """
+        Returns the compression matching a key's extension (see COMPRESSION_EXTENSIONS),
+        or None for uncompressed files.
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if compression is not None and key.endswith(extension):
+            return compression
+    return None
+
 
 class s3(object):
     """
@@ -17,9 +79,19 @@ class s3(object):
         self.access_key = access_key
         self.secret_key = secret_key
         self.bucket = bucket
+        import boto3
+        from boto3.s3.transfer import TransferConfig
         self.client = boto3.client('s3',
                                    aws_access_key_id=self.access_key,
                                    aws_secret_access_key=self.secret_key)
+        # files over 8MB are uploaded in parts on up to 10 threads
+        self.transfer_config = TransferConfig(multipart_threshold=8 * MB,
+                                              multipart_chunksize=8 * MB,
+                                              max_concurrency=10)
+        # and downloaded as 8MB byte ranges on up to 16 threads
+        self.download_config = TransferConfig(multipart_threshold=8 * MB,
+                                              multipart_chunksize=8 * MB,
+                                              max_concurrency=16)
 
     def df_to_s3(self,
                  df,
@@ -27,14 +99,52 @@ class s3(object):
                  bucket=None,
                  subdirectory=None,
                  gzip=False,
-                 encoding='utf-8'):
-        data = df.to_csv(index=False, encoding=encoding)
+                 encoding='utf-8',
+                 file_format='csv',
+                 compression=None,
+                 overwrite=True):
+        """
+            Serializes a DataFrame and uploads it to s3. Returns the key of the
+            uploaded file, or None when the upload fails.
+
+            Parameters
+            ----------
+            file_format : str
+                either 'csv' or 'parquet'. Parquet requires pyarrow.
+                Default: 'csv'
+
+            compression : str
+                None, 'gzip' or 'zstd'. Only applies to csv, parquet is always
+                snappy compressed. gzip=True is the same as compression='gzip'.
+                Default: None
+
+            overwrite : bool
+                When False and the key already exists, the DataFrame is not
+                serialized or uploaded and the existing key is returned.
+                Default: True
+        """
+        if gzip and compression is None:
+            compression = 'gzip'
         try:
-            key = self.csv_to_s3(data, obj_name, bucket, subdirectory, gzip)
+            if not overwrite:
+                key = self.get_key(obj_name, subdirectory)
+                if self.object_exists(key, bucket=bucket):
+                    log.info('{0} already exists, skipping upload'.format(key))
+                    return key
+            if file_format == 'parquet':
+                key = self.parquet_to_s3(df, obj_name, bucket, subdirectory)
+            else:
+                key = self.stream_csv_to_s3(df,
+                                            obj_name,
+                                            bucket,
+                                            subdirectory,
+                                            encoding=encoding,
+                                            compression=compression,
+                                            overwrite=overwrite)
             return key
-        except Exception:
-            log.error('error sending {0} to {1}/{2}'.format(
-                obj_name, bucket, subdirectory))
+        except Exception as e:
+            log.exception('error sending {0} to {1}/{2}: {3}'.format(
+                obj_name, bucket, subdirectory, e))
             return None
 
     def csv_to_s3(self,
@@ -42,22 +152,171 @@ class s3(object):
                   obj_name,
                   bucket=None,
                   subdirectory=None,
-                  gzip=False):
+                  gzip=False,
+                  overwrite=True):
         if bucket is None:
             bucket = self.bucket
         if gzip:
             data = compress(data.encode('utf-8'))
-        if subdirectory is None:
-            subdirectory = ''
-        else:
-            subdirectory = subdirectory + '/'
-        key = subdirectory + obj_name
-        self.client.put_object(Body=data, Bucket=bucket, Key=key)
-        log.info('saved {0} to {1}/{2}'.format(obj_name, bucket, subdirectory))
+        key = self.get_key(obj_name, subdirectory)
+        if self.put_object(data, key, bucket, overwrite=overwrite):
+            log.info('saved {0} to s3 bucket {1}'.format(key, bucket))
+        return key
+
+    def stream_csv_to_s3(self,
+                         df,
+                         obj_name,
+                         bucket=None,
+                         subdirectory=None,
+                         encoding='utf-8',
+                         compression=None,
+                         overwrite=True,
+                         chunk_rows=CSV_CHUNK_ROWS):
+        """
+            Uploads a DataFrame as csv without materializing the whole file. Rows are
+            serialized (and compressed) chunk_rows at a time into parts of
+            self.transfer_config.multipart_chunksize bytes, which are sent as a multipart
+            upload on up to max_concurrency threads. Only the parts in flight are held in
+            memory. Files smaller than one part are sent with a single put.
+
+            Parameters
+            ----------
+            compression : str
+                None, 'gzip' or 'zstd'
+                Default: None
+
+            overwrite : bool
+                When False, the final write is conditional (IfNoneMatch) so an object
+                written concurrently under the same key is kept.
+                Default: True
+        """
+        from botocore.exceptions import ClientError
+        if bucket is None:
+            bucket = self.bucket
+        key = self.get_key(obj_name, subdirectory)
+        conditions = {} if overwrite else {'IfNoneMatch': '*'}
+        part_size = self.transfer_config.multipart_chunksize
+        max_concurrency = self.transfer_config.max_concurrency
+        compressor = get_compressor(compression)
+        upload_id = None
+        pending = set()
+        uploads = []
+        part = io.BytesIO()
+
+        def upload_part(body, part_number):
+            resp = self.client.upload_part(Body=body,
+                                           Bucket=bucket,
+                                           Key=key,
+                                           PartNumber=part_number,
+                                           UploadId=upload_id)
+            return {'ETag': resp['ETag'], 'PartNumber': part_number}
+
+        def submit_part(executor):
+            # wait for a free thread so at most max_concurrency parts are buffered
+            while len(pending) >= max_concurrency:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending.difference_update(done)
+                # stop at the first failed part rather than after serializing the rest
+                for future in done:
+                    future.result()
+            future = executor.submit(upload_part, part.getvalue(),
+                                     len(uploads) + 1)
+            pending.add(future)
+            uploads.append(future)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            try:
+                for start in range(0, max(len(df), 1), chunk_rows):
+                    chunk = io.BytesIO()
+                    write_csv(df.iloc[start:start + chunk_rows],
+                              chunk,
+                              encoding=encoding,
+                              header=start == 0)
+                    data = chunk.getbuffer()
+                    if compressor is not None:
+                        data = compressor.compress(data)
+                    part.write(data)
+                    if part.tell() >= part_size:
+                        if upload_id is None:
+                            upload_id = self.client.create_multipart_upload(
+                                Bucket=bucket, Key=key)['UploadId']
+                        submit_part(executor)
+                        part = io.BytesIO()
+                if compressor is not None:
+                    part.write(compressor.flush())
+
+                if upload_id is None:
+                    self.client.put_object(Body=part.getvalue(),
+                                           Bucket=bucket,
+                                           Key=key,
+                                           **conditions)
+                else:
+                    if part.tell() > 0:
+                        submit_part(executor)
+                    parts = [future.result() for future in uploads]
+                    self.client.complete_multipart_upload(
+                        Bucket=bucket,
+                        Key=key,
+                        UploadId=upload_id,
+                        MultipartUpload={'Parts': parts},
+                        **conditions)
+            except Exception as e:
+                if upload_id is not None:
+                    # parts still uploading after the abort would be stored again,
+                    # so let them finish first
+                    for future in pending:
+                        future.cancel()
+                    executor.shutdown(wait=True)
+                    self.client.abort_multipart_upload(Bucket=bucket,
+                                                       Key=key,
+                                                       UploadId=upload_id)
+                if not (isinstance(e, ClientError) and e.response['Error']
+                        ['Code'] in CONDITIONAL_WRITE_ERRORS):
+                    raise
+                log.info('{0} was written concurrently, skipping upload'.format(
+                    key))
+                return key
+        log.info('saved {0} to s3 bucket {1}'.format(key, bucket))
+        return key
+
+    def parquet_to_s3(self, df, obj_name, bucket=None, subdirectory=None):
+        """
+            Writes a DataFrame as snappy compressed parquet and uploads it to s3.
+            The index is not written, so the file columns match df.columns.
+        """
+        buf = io.BytesIO()
+        df.to_parquet(buf, index=False, compression='snappy')
+        buf.seek(0)
+        return self.fileobj_to_s3(buf, obj_name, bucket, subdirectory)
+
+    def fileobj_to_s3(self, fileobj, obj_name, bucket=None, subdirectory=None):
+        """
+            Uploads a binary file-like object to s3. Large files are sent as a
+            concurrent multipart upload, see self.transfer_config.
+        """
+        if bucket is None:
+            bucket = self.bucket
+        key = self.get_key(obj_name, subdirectory)
+        self.client.upload_fileobj(fileobj,
+                                   bucket,
+                                   key,
+                                   Config=self.transfer_config)
+        log.info('saved {0} to s3 bucket {1}'.format(key, bucket))
         return key
 
-    def s3_to_df(self, key, bucket=None):
+    def get_key(self, obj_name, subdirectory=None):
         """
+            Returns the s3 key for an object, e.g. 'subdirectory/obj_name'
+        """
+        if subdirectory is None:
+            return obj_name
+        return subdirectory + '/' + obj_name
+
+    def s3_to_df(self, key, bucket=None, compression='infer'):
+        """
+            Reads a csv in s3 into a DataFrame. Files over 8MB are downloaded as
+            concurrent byte range requests, see self.download_config.
+
             Parameters
             ----------
             bucket : str
@@ -65,13 +324,27 @@ class s3(object):
 
             key : str
                 path to the file. Usually 'subdirectory/file_name'
+
+            compression : str
+                None, 'gzip' or 'zstd'. 'infer' picks one from the key's extension.
+                Default: 'infer'
         """
-        data = self.s3_to_csv(key=key, bucket=bucket)
+        import pandas as pd
+        if bucket is None:
+            bucket = self.bucket
+        if compression == 'infer':
+            compression = get_compression_from_key(key)
+        buf = io.BytesIO()
+        self.client.download_fileobj(bucket,
+                                     key,
+                                     buf,
+                                     Config=self.download_config)
+        buf.seek(0)
         try:
-            df = pd.read_csv(data['Body'])
+            df = pd.read_csv(buf, compression=compression)
             return df
         except ValueError as e:
-            log.error("Error getting {0} from {1}: {}".format(key, bucket, e))
+            log.error("Error getting {0} from {1}: {2}".format(key, bucket, e))
             return None
 
     def s3_to_csv(self, key, bucket=None):
@@ -95,12 +368,58 @@ class s3(object):
         data = self.client.get_object(Bucket=bucket, Key=key)
         return data['Body']
 
-    def to_s3(self, data, key, bucket=None):
+    def to_s3(self, data, key, bucket=None, overwrite=True):
         if bucket is None:
             bucket = self.bucket
-        self.client.put_object(Body=data, Bucket=bucket, Key=key)
+        self.put_object(data, key, bucket, overwrite=overwrite)
         return key
 
+    def put_object(self, data, key, bucket, overwrite=True):
+        """
+            Puts data at key. When overwrite is False an existing object is kept: the
+            put is skipped if a HEAD finds the key, and is otherwise sent with
+            IfNoneMatch='*' so a concurrent writer's object isn't replaced either.
+
+            Returns
+            -------
+            bool: data was written
+        """
+        from botocore.exceptions import ClientError
+        if overwrite:
+            self.client.put_object(Body=data, Bucket=bucket, Key=key)
+            return True
+        if self.object_exists(key, bucket=bucket):
+            log.info('{0} already exists, skipping upload'.format(key))
+            return False
+        try:
+            self.client.put_object(Body=data,
+                                   Bucket=bucket,
+                                   Key=key,
+                                   IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CONDITIONAL_WRITE_ERRORS:
+                raise
+            log.info('{0} was written concurrently, skipping upload'.format(key))
+            return False
+        return True
+
+    def object_exists(self, key, bucket=None):
+        """
+            Returns
+            -------
+            bool: key exists in the s3 bucket
+        """
+        from botocore.exceptions import ClientError
+        if bucket is None:
+            bucket = self.bucket
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
     def delete_file(self, key, bucket=None):
         if bucket is None:
             bucket = self.bucket
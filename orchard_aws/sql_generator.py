@@ -1,40 +1,118 @@
 import logging
-import pandas as pd
-from .string_utils import *
-import yaml
+import warnings
+from functools import lru_cache
 from . import config
 
 log = logging.getLogger('SQL Generator')
 
-
-def get_table_exists_query(schema, table):
-    query = """
+# query templates, filled in with str.format by the get_*_query functions below
+TABLE_EXISTS_QUERY = """
         select
             count(*)
         from INFORMATION_SCHEMA.TABLES
-        where table_schema = '{schema}' and table_name = '{table}';
-    """.format(schema=schema, table=table)
+        where table_schema = {schema} and table_name = {table};
+    """
+
+TABLES_EXIST_QUERY = """
+        select
+            table_schema || '.' || table_name as schema_and_table
+        from INFORMATION_SCHEMA.TABLES
+        where table_schema || '.' || table_name in ({tables});
+    """
+
+COPY_FROM_S3_QUERY = """
+        copy {schema_and_table}{columns}
+        from 's3://{s3_path}'
+        {format_params}
+        credentials 'aws_access_key_id={{access_key}};aws_secret_access_key={{secret_key}}'
+        {extra_params}
+        """
+
+DELETE_FROM_DEST_USING_SOURCE_QUERY = '''delete from {dest} using {source}
+        where {conditions}'''
+
+INSERT_FROM_SOURCE_INTO_DEST_QUERY = '''insert into {dest}
+        select * from {source}'''
+
+
+def quote_identifier(name):
+    """
+        Returns name as a double quoted identifier, escaping embedded double quotes.
+
+        Example
+        -------
+        quote_identifier('order id')
+        >> '"order id"'
+    """
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def quote_literal(value):
+    """
+        Returns value as a single quoted string literal. Redshift treats backslashes
+        in literals as escapes, so they are escaped along with single quotes.
+
+        Example
+        -------
+        quote_literal("o'brien")
+        >> "'o''brien'"
+    """
+    escaped = str(value).replace('\\', '\\\\').replace("'", "''")
+    return "'{}'".format(escaped)
+
+
+@lru_cache(maxsize=1024)
+def get_table_exists_query(schema, table):
+    query = TABLE_EXISTS_QUERY.format(schema=quote_literal(schema),
+                                      table=quote_literal(table))
+    return query
+
+
+def get_tables_exist_query(schema_and_tables):
+    """
+        Returns a query listing which of the given tables exist, as one
+        schema.table value per row.
+
+        Parameters
+        -------
+            schema_and_tables: [List of strings]
+            e.g. ['public.orders', 'public.customers']
+    """
+    tables = ', '.join(quote_literal(table) for table in schema_and_tables)
+    query = TABLES_EXIST_QUERY.format(tables=tables)
     return query
 
 
 def get_copy_from_s3_query(schema_and_table,
                            columns,
                            s3_path,
-                           extra_params=[]):
-    if not extra_params:
-        extra_params = ''
+                           extra_params=[],
+                           file_format='csv',
+                           compression=None):
+    """
+        Returns the copy query used to load a file from s3. The credentials are
+        left as {access_key} and {secret_key} placeholders.
+
+        Parameters
+        -------
+            file_format: str
+            either 'csv' or 'parquet'. Csv files are expected to have a header row.
+
+            compression: str
+            None, 'gzip' or 'zstd'. Ignored for parquet, which redshift decompresses itself.
+    """
+    extra_params = ' '.join(extra_params) if extra_params else ''
+    if file_format == 'parquet':
+        format_params = 'format as parquet'
     else:
-        extra_params = list_to_string(string_list=extra_params, delimiter=' ')
-    query = """
-        copy {schema_and_table}{columns}
-        from 's3://{s3_path}'
-        ignoreheader 1
-        credentials 'aws_access_key_id={{access_key}};aws_secret_access_key={{secret_key}}'
-        {extra_params}
-        """.format(schema_and_table=schema_and_table,
-                   columns=columns,
-                   s3_path=s3_path,
-                   extra_params=extra_params)
+        format_params = 'ignoreheader 1'
+        if compression is not None:
+            format_params += ' {}'.format(compression)
+    query = COPY_FROM_S3_QUERY.format(schema_and_table=schema_and_table,
+                                      columns=columns,
+                                      s3_path=s3_path,
+                                      format_params=format_params,
+                                      extra_params=extra_params)
     return query
 
 
@@ -55,24 +133,24 @@ def get_delete_from_dest_using_source_query(source, dest, primary_keys):
 
         Example
         -------
-        get_delete_from_dest_using_source_query('orders', 'orders__temp', ['id'] )
-        >> 'delete from orders using order__temp where 1=1 and orders.id = order__temp.id'
-    """
-    where_clause = 'where 1=1 '
-    for key in primary_keys:
-        where_clause += 'and {source}."{key}" = {dest}."{key}" '.format(
-            source=source, dest=dest, key=key)
-    query = '''delete from {dest} using {source}
-        {where_clause}'''.format(dest=dest,
-                                 source=source,
-                                 where_clause=where_clause)
+        get_delete_from_dest_using_source_query('orders__tmp', 'orders', ['id'])
+        >> 'delete from orders using orders__tmp where orders__tmp."id" = orders."id"'
+    """
+    if not primary_keys:
+        raise Exception('Must pass primary keys to delete using a source table.')
+    conditions = ' and '.join('{source}.{key} = {dest}.{key}'.format(
+        source=source, dest=dest, key=quote_identifier(key))
+                              for key in primary_keys)
+    query = DELETE_FROM_DEST_USING_SOURCE_QUERY.format(dest=dest,
+                                                       source=source,
+                                                       conditions=conditions)
     log.debug('delete from dest using source query:\n{}'.format(query))
     return query
 
 
 def get_insert_from_source_into_dest_query(source, dest):
-    query = '''insert into {dest}
-        select * from {source}'''.format(dest=dest, source=source)
+    query = INSERT_FROM_SOURCE_INTO_DEST_QUERY.format(dest=dest,
+                                                      source=source)
     log.debug('Insert from source into dest query:\n{}'.format(query))
     return query
 
@@ -94,8 +172,18 @@ def get_create_temp_staging_table_query(temp_table, schema_and_table):
     return query
 
 
+def _warn_deprecated(name):
+    warnings.warn(
+        '{} is deprecated and will be removed; create_table_ddl_from_df builds '
+        'column definitions with get_column_ddl.'.format(name),
+        DeprecationWarning,
+        stacklevel=3)
+
+
 def get_pandas_datatype_frame(df):
     """
+        Deprecated, see get_column_ddl.
+
         Returns a dataframe with a row for each column in the original datagrame:
 
         Returns
@@ -105,29 +193,49 @@ def get_pandas_datatype_frame(df):
             -----   ----
             col1  | col1 datatype
     """
+    _warn_deprecated('get_pandas_datatype_frame')
     return df.dtypes.to_frame(name='pandas_type').reset_index()
 
 
 def add_redshift_type_column(df, type_map):
-    """Creates a column, that is the redhsift version of `pandas_type`"""
+    """Deprecated, see get_column_ddl. Creates a column, that is the redhsift version of `pandas_type`"""
+    _warn_deprecated('add_redshift_type_column')
     df['redshift_type'] = df['pandas_type'].astype(str).map(type_map)
     return df
 
 
 def add_column_ddl(df):
-    """Creates column with the definition for each column in table"""
-    df['column_ddl'] = '"' + df['index'] + '" ' + df['redshift_type'] + ","
+    """Deprecated, see get_column_ddl. Creates column with the definition for each column in table"""
+    _warn_deprecated('add_column_ddl')
+    df['column_ddl'] = [
+        get_column_ddl(name, redshift_type, pandas_type) + ','
+        for name, redshift_type, pandas_type in zip(
+            df['index'], df['redshift_type'], df['pandas_type'])
+    ]
     return df
 
 
+def get_column_ddl(name, redshift_type, pandas_type):
+    """
+        Returns the definition of one column, e.g. '"col1" bigint'. Raises when the
+        pandas type has no redshift type in config/pandas_redshift_datatypes.yaml.
+    """
+    if not isinstance(redshift_type, str):
+        raise Exception(
+            'No redshift type for column {} with pandas type {}.'.format(
+                name, pandas_type))
+    return '{} {}'.format(quote_identifier(name), redshift_type)
+
+
 def get_ddl_string(df):
     """
-        Joins each column ddl into one ddl string.
+        Deprecated, see get_column_ddl. Joins each column ddl into one ddl string.
 
         Returns
         -------
         '"col1" varchar(500), "col2" timestamp, "col3" bigint'
     """
+    _warn_deprecated('get_ddl_string')
     return ' '.join(df.column_ddl)[:-1]
 
 
@@ -139,7 +247,7 @@ def get_table_config_string(diststyle, sortkey):
     config = ''
     if diststyle is not None:
         config = config + 'diststyle {} '.format(diststyle)
-    if sortkey is not None:
+    if sortkey:
         config = config + 'sortkey({})'.format(sortkey)
     return config
 
@@ -170,10 +278,9 @@ def create_table_ddl_from_df(schema_and_table,
             When true, add an __updated_at column to the create table statement
     """
     type_map = config.get('pandas_redshift_datatypes')
-    df = get_pandas_datatype_frame(df)
-    df = add_redshift_type_column(df, type_map)
-    df = add_column_ddl(df)
-    ddl_string = get_ddl_string(df)
+    ddl_string = ', '.join(
+        get_column_ddl(name, type_map.get(str(dtype)), dtype)
+        for name, dtype in df.dtypes.items())
     base_string = get_ddl_base_string(add_updated_column)
     table_config_string = get_table_config_string(diststyle, sortkey)
     create_table_ddl = base_string % (schema_and_table, ddl_string,
@@ -9,6 +9,13 @@ setup(
     author='Ryan Brennan',
     author_email='ryantbrennan1@gmail.com',
     python_requires='>=3',
-    install_requires=['pandas', 'numpy', 'psycopg2-binary', 'boto3', 'pyyaml'],
+    install_requires=[
+        'pandas', 'numpy', 'psycopg2-binary', 'boto3>=1.35.2',
+        'botocore>=1.35.2', 'pyyaml'
+    ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'zstd': ['zstandard']
+    },
     package_data={'': ['*.yaml']},
     include_package_data=True)